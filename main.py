@@ -1,10 +1,17 @@
 import os
-import json
+import re
 import time
-import threading
-import requests
+import random
+import asyncio
+import functools
+import itertools
+import aiohttp
+import orjson
+import redis.asyncio as redis
+from aiohttp import web
 from datetime import datetime
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from hashlib import blake2b
+from uuid import uuid4
 
 # ---------- CONFIG ----------
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -15,39 +22,176 @@ API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 MINHA_URL = os.getenv("MINHA_URL", "https://minha.anem.dz/pre_inscription")
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL_SECONDS", "60"))
 
-SUBSCRIBERS_FILE = "subscribers.json"
+# webhook mode when PUBLIC_URL is set (e.g. https://<app>.up.railway.app), long-polling otherwise
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or blake2b(TELEGRAM_TOKEN.encode(), digest_size=16).hexdigest()
+WEBHOOK_PATH = f"/telegram/{WEBHOOK_SECRET}"
+ALLOWED_UPDATES = ["message"]
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SUBSCRIBERS_KEY = "minha:subscribers"
+LANG_KEY = "minha:lang"
+CHANGED_CHANNEL = "minha:changed"
+MONITOR_LOCK_KEY = "minha:lock"
+PAGE_KEY = "minha:page"
+NOTIFIED_KEY = "minha:notified"
+NOTIFY_DEBOUNCE = int(os.getenv("NOTIFY_DEBOUNCE_SECONDS", "300"))
+MONITOR_LOCK_TTL = CHECK_INTERVAL * 3
+INSTANCE_ID = uuid4().hex
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "25"))  # sender workers
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "10000"))  # queued broadcast messages
+BACKOFF_CAP = 60  # seconds, longest wait between retries after errors
+SEND_RATE = int(os.getenv("SEND_RATE_PER_SECOND", "30"))  # Telegram global bot limit
 
 # ---------- LANGUAGE DETECTION ----------
-ARABIC_LETTERS = set("ابتثجحخدذرزسشصضطظعغفقكلمنهويىءئة")
 FRENCH_KEYWORDS = ("ministère", "demande", "inscription", "offre", "emploi", "bonjour", "merci")
+ARABIC_RE = re.compile(r"[\u0600-\u06FF]")
+FRENCH_RE = re.compile("|".join(map(re.escape, FRENCH_KEYWORDS)), re.IGNORECASE)
 
-def detect_language(text: str) -> str:
-    t = text.lower()
-    if any(ch in ARABIC_LETTERS for ch in t):
+def detect_language(text: str) -> str | None:
+    # None when nothing matched: "ok 👍" is not evidence of English
+    if ARABIC_RE.search(text):
         return "ar"
-    if any(k in t for k in FRENCH_KEYWORDS):
+    if FRENCH_RE.search(text):
         return "fr"
-    return "en"
+    return None
+
+def command_language(msg):
+    # command text like "/minha" says nothing about the user's language; the
+    # Telegram client language does, when it is one we speak
+    code = (msg.get('from') or {}).get('language_code') or ''
+    code = code[:2].lower()
+    return code if code in ("ar", "fr", "en") else None
 
 # ---------- SUBSCRIBERS HANDLING ----------
-def load_subscribers():
-    if os.path.exists(SUBSCRIBERS_FILE):
-        with open(SUBSCRIBERS_FILE, "r", encoding="utf-8") as f:
-            return set(json.load(f))
-    return set()
+REDIS = redis.from_url(REDIS_URL, decode_responses=True)
+
+async def add_subscriber(chat_id, lang):
+    # lang is None when the command gave no real signal: leave minha:lang alone
+    # so alerts keep the Arabic default; returns the language alerts will use
+    pipe = REDIS.pipeline().sadd(SUBSCRIBERS_KEY, chat_id)
+    if lang:
+        pipe.hset(LANG_KEY, chat_id, lang)
+    *_, stored = await pipe.hget(LANG_KEY, chat_id).execute()
+    return stored or "ar"
+
+async def remove_subscriber(chat_id):
+    await REDIS.pipeline().srem(SUBSCRIBERS_KEY, chat_id).hdel(LANG_KEY, chat_id).execute()
+
+# the language hash only ever holds subscribers, so it can't grow with
+# everyone who chats with the bot; check and write in one round trip
+REMEMBER_LANGUAGE = REDIS.register_script("""
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+return 0
+""")
+
+async def remember_language(chat_id, lang):
+    await REMEMBER_LANGUAGE(keys=[SUBSCRIBERS_KEY, LANG_KEY], args=[chat_id, lang])
+
+async def iter_subscribers(batch=500):
+    # (chat_id, lang) pairs walked with SSCAN, so only one batch is held in
+    # memory at a time; Arabic when no language is known. SSCAN can repeat a
+    # member when the set is rehashed mid-walk, and such a subscriber gets the
+    # alert twice: accepted, since deduplicating would need an O(N) seen-set
+    cursor = 0
+    while True:
+        cursor, chat_ids = await REDIS.sscan(SUBSCRIBERS_KEY, cursor, count=batch)
+        if chat_ids:
+            langs = await REDIS.hmget(LANG_KEY, chat_ids)
+            for chat_id, lang in zip(chat_ids, langs):
+                yield chat_id, lang or "ar"
+        if cursor == 0:
+            return
+
+# ---------- RETRIES ----------
+async def backoff_sleep(backoff):
+    # exponential backoff with jitter so replicas don't retry in lockstep
+    # during an outage; returns the delay to use after the next failure
+    await asyncio.sleep(min(BACKOFF_CAP, backoff) + random.uniform(0, backoff / 2))
+    return min(BACKOFF_CAP, backoff * 2)
 
-def save_subscribers():
-    with open(SUBSCRIBERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(list(SUBSCRIBERS), f)
+# ---------- RATE LIMITING ----------
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
 
-SUBSCRIBERS = load_subscribers()
+    def pause(self, seconds):
+        # flood control applies to the whole bot, so every sender waits it out
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    # no refill for the time spent blocked
+                    self.updated = time.monotonic()
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+BUCKET = TokenBucket(SEND_RATE)
 
 # ---------- TELEGRAM FUNCTIONS ----------
-def send_message(chat_id, text):
-    try:
-        requests.post(f"{API_URL}/sendMessage", data={"chat_id": chat_id, "text": text})
-    except Exception as e:
-        print(f"[send_message] error {e}")
+# every outgoing message goes through OUT_Q; a fixed pool of sender workers
+# drains it, so a broadcast plus a burst of replies never exceeds
+# SEND_CONCURRENCY requests in flight. Replies jump ahead of queued broadcast
+# messages and never wait for room; only the broadcaster is pushed back on,
+# once SEND_QUEUE_SIZE of its messages are waiting
+REPLY, BROADCAST = 0, 1
+OUT_Q = asyncio.PriorityQueue()
+OUT_SEQ = itertools.count()  # keeps FIFO order within a priority
+BROADCAST_SLOTS = asyncio.Semaphore(SEND_QUEUE_SIZE)
+
+async def send_message(chat_id, text):
+    OUT_Q.put_nowait((REPLY, next(OUT_SEQ), chat_id, text))
+
+async def send_broadcast(chat_id, text):
+    await BROADCAST_SLOTS.acquire()
+    OUT_Q.put_nowait((BROADCAST, next(OUT_SEQ), chat_id, text))
+
+async def deliver(session, chat_id, text):
+    while True:
+        try:
+            await BUCKET.acquire()
+            payload = orjson.dumps({"chat_id": chat_id, "text": text})
+            async with session.post(f"{API_URL}/sendMessage", data=payload, headers=JSON_HEADERS) as r:
+                if r.status != 429:
+                    await r.read()
+                    return
+                data = orjson.loads(await r.read())
+            # flood control: hold back all senders as long as Telegram asks, then try again
+            retry_after = data.get("parameters", {}).get("retry_after", 1)
+            print(f"[sender] rate limited, pausing sends for {retry_after}s")
+            BUCKET.pause(retry_after)
+        except Exception as e:
+            print(f"[sender] error {e}")
+            return
+
+async def sender(session):
+    while True:
+        priority, _, chat_id, text = await OUT_Q.get()
+        try:
+            await deliver(session, chat_id, text)
+        finally:
+            OUT_Q.task_done()
+            if priority == BROADCAST:
+                BROADCAST_SLOTS.release()
 
 WELCOME = {
     "ar": "مرحباً! هذا بوت تنبيهات منحة البطالة. اكتب /minha للحصول على آخر الأخبار.",
@@ -55,126 +199,377 @@ WELCOME = {
     "en": "Welcome! This is the Minha alerts bot. Type /minha for latest updates.",
 }
 
-def ai_reply(user_text, lang):
-    t = user_text.lower()
-    if any(x in t for x in ("متى","وقت","مفتوح")):
-        return {
-            "ar":"الموقع لا يملك وقت ثابت، سنرسل لك إشعاراً أول ما يفتح.",
-            "fr":"Le site n'a pas d'horaire fixe. Nous vous enverrons une alerte dès qu'il ouvre.",
-            "en":"The site has no fixed opening time. You'll get notified when it opens."
-        }[lang]
-    if any(x in t for x in ("كيف","وثائق","documents")):
-        return {
-            "ar":"الوثائق المطلوبة عادة: بطاقة وطنية، شهادة الحالة، تحقق من الوكالة.",
-            "fr":"Documents typiques: carte d'identité, justificatif, vérifiez localement.",
-            "en":"Typical docs: ID card, proof of status, check locally."
-        }[lang]
-    return {
+REPLIES = {
+    "time": {
+        "ar":"الموقع لا يملك وقت ثابت، سنرسل لك إشعاراً أول ما يفتح.",
+        "fr":"Le site n'a pas d'horaire fixe. Nous vous enverrons une alerte dès qu'il ouvre.",
+        "en":"The site has no fixed opening time. You'll get notified when it opens."
+    },
+    "docs": {
+        "ar":"الوثائق المطلوبة عادة: بطاقة وطنية، شهادة الحالة، تحقق من الوكالة.",
+        "fr":"Documents typiques: carte d'identité, justificatif, vérifiez localement.",
+        "en":"Typical docs: ID card, proof of status, check locally."
+    },
+    "default": {
         "ar":"أستطيع تنبيهك عند فتح الموقع أو الإجابة عن أسئلة بسيطة. اكتب /minha.",
         "fr":"Je peux vous alerter ou répondre à des questions simples. Tapez /minha.",
         "en":"I can alert you or answer simple questions. Type /minha."
-    }[lang]
+    },
+}
+
+# one compiled alternation per intent, checked in order; input is already lowercased
+INTENTS = [
+    ("time", re.compile("|".join(map(re.escape, ("متى","وقت","مفتوح","quand","horaire","when","open"))))),
+    ("docs", re.compile("|".join(map(re.escape, ("كيف","وثائق","documents"))))),
+]
+
+@functools.lru_cache(maxsize=2048)
+def ai_reply(user_text_lower: str, lang: str) -> str:
+    for intent, pattern in INTENTS:
+        if pattern.search(user_text_lower):
+            return REPLIES[intent][lang]
+    return REPLIES["default"][lang]
 
 # ---------- MONITOR ----------
-LAST_CONTENT = None
-
-def notify_all_subscribers():
-    msg = {
-        "ar": f"تنبيه: تم تحديث صفحة التسجيل لمنحة البطالة. ادخل الآن: {MINHA_URL}",
-        "fr": f"Alerte: la page de pré-inscription a été mise à jour. Vérifiez: {MINHA_URL}",
-        "en": f"Alert: Minha pre-inscription page updated. Check: {MINHA_URL}"
-    }
-    for chat_id in list(SUBSCRIBERS):
-        send_message(chat_id, msg["ar"])  # default Arabic, can extend per-user language
-
-def monitor_loop():
-    global LAST_CONTENT
+ALERT_MSG = {
+    "ar": f"تنبيه: تم تحديث صفحة التسجيل لمنحة البطالة. ادخل الآن: {MINHA_URL}",
+    "fr": f"Alerte: la page de pré-inscription a été mise à jour. Vérifiez: {MINHA_URL}",
+    "en": f"Alert: Minha pre-inscription page updated. Check: {MINHA_URL}"
+}
+
+class BroadcastError(Exception):
+    def __init__(self, queued):
+        super().__init__(f"broadcast failed after {queued} alerts")
+        self.queued = queued
+
+async def notify_all_subscribers():
+    # returns how many alerts were queued; a failure partway raises
+    # BroadcastError carrying the count so far
+    queued = 0
+    try:
+        async for chat_id, lang in iter_subscribers():
+            await send_broadcast(chat_id, ALERT_MSG.get(lang, ALERT_MSG["ar"]))
+            queued += 1
+            if queued % 500 == 0:
+                # a walk paced at SEND_RATE can outlast the debounce window;
+                # keep the claim alive until this change is committed
+                await REFRESH_LOCK(keys=[NOTIFIED_KEY], args=[INSTANCE_ID, NOTIFY_DEBOUNCE])
+    except Exception as e:
+        raise BroadcastError(queued) from e
+    return queued
+
+# compare-and-expire in one step, so a lock that expired and was taken by
+# another replica in between is never extended on its behalf
+REFRESH_LOCK = REDIS.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+async def hold_monitor_lock():
+    # take the lock if it is free, or extend it if this replica already owns it
+    if await REDIS.set(MONITOR_LOCK_KEY, INSTANCE_ID, nx=True, ex=MONITOR_LOCK_TTL):
+        return True
+    return bool(await REFRESH_LOCK(keys=[MONITOR_LOCK_KEY], args=[INSTANCE_ID, MONITOR_LOCK_TTL]))
+
+async def page_changed(session):
+    # validators and a 16-byte digest of the last body live in Redis, so
+    # whichever replica holds the monitor lock picks up where the last one left off.
+    # Returns the new page state on a change; the broadcaster saves it once
+    # the alerts have been handed off, so a change that wasn't announced is
+    # detected again on the next poll
+    page = await REDIS.hgetall(PAGE_KEY)
+    if page.get("length") and page.get("last_modified"):
+        # cheap HEAD first for servers that ignore conditional GETs; only
+        # usable when they report both a length and a modification date
+        async with session.head(MINHA_URL, timeout=aiohttp.ClientTimeout(total=10)) as h:
+            if (h.headers.get("Content-Length") == page["length"]
+                    and h.headers.get("Last-Modified") == page["last_modified"]):
+                return None
+    headers = {}
+    if page.get("etag"):
+        headers["If-None-Match"] = page["etag"]
+    if page.get("last_modified"):
+        headers["If-Modified-Since"] = page["last_modified"]
+    async with session.get(MINHA_URL, headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as r:
+        if r.status == 304:
+            return None
+        if r.status != 200:
+            # outage or maintenance page: not a change, leave the stored state
+            # alone and let monitor_loop back off
+            raise RuntimeError(f"{MINHA_URL} answered HTTP {r.status}")
+        state = {
+            "digest": blake2b(await r.read(), digest_size=16).hexdigest(),
+            "etag": r.headers.get("ETag", ""),
+            "last_modified": r.headers.get("Last-Modified", ""),
+            "length": r.headers.get("Content-Length", ""),
+        }
+    if page.get("digest") and state["digest"] != page["digest"]:
+        return state
+    # first fetch or same body: just refresh the validators
+    await REDIS.hset(PAGE_KEY, mapping=state)
+    return None
+
+async def monitor_loop(session):
     print(f"[monitor] starting. Monitoring {MINHA_URL} every {CHECK_INTERVAL}s")
+    backoff = 1
     while True:
         try:
-            r = requests.get(MINHA_URL, timeout=15)
-            content = r.text
-            if LAST_CONTENT is None:
-                LAST_CONTENT = content
-            elif content != LAST_CONTENT:
+            state = await hold_monitor_lock() and await page_changed(session)
+            if state:
                 print("[monitor] change detected!")
-                LAST_CONTENT = content
-                notify_all_subscribers()
+                # pub/sub keeps nothing, but the old digest stays until a broadcaster
+                # commits the new one, so an unheard change is seen again next poll
+                if not await REDIS.publish(CHANGED_CHANNEL, orjson.dumps(state)):
+                    print("[monitor] no broadcaster listening, retrying next poll")
+            backoff = 1
         except Exception as e:
             print("[monitor] error:", e)
-        time.sleep(CHECK_INTERVAL)
+            # back off on top of the regular interval, never poll faster than it
+            backoff = await backoff_sleep(backoff)
+        await asyncio.sleep(CHECK_INTERVAL)
+
+# ---------- BROADCASTER ----------
+# compare-and-delete, so a replica only ever gives back its own claim
+RELEASE_CLAIM = REDIS.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+async def announce_change(state):
+    # every replica hears the event and the page may keep changing while it is
+    # edited: at most one broadcast per debounce window, cluster-wide. Changes
+    # inside the window stay uncommitted, so the monitor re-reports the latest
+    # one and it is announced once the window is over
+    if await REDIS.hget(PAGE_KEY, "digest") == state["digest"]:
+        return  # already announced, e.g. an event queued up during our own walk
+    if not await REDIS.set(NOTIFIED_KEY, INSTANCE_ID, nx=True, ex=NOTIFY_DEBOUNCE):
+        print("[broadcast] change within debounce window, deferring")
+        return
+    try:
+        await notify_all_subscribers()
+    except BroadcastError as e:
+        if not e.queued:
+            # nothing went out: free the window so the next poll retries at once
+            await RELEASE_CLAIM(keys=[NOTIFIED_KEY], args=[INSTANCE_ID])
+        # otherwise the retry waits out the window; some subscribers may get
+        # the alert twice, which beats the rest never getting it
+        raise
+    await REDIS.hset(PAGE_KEY, mapping=state)
+    # the window runs from the end of the broadcast
+    await REDIS.set(NOTIFIED_KEY, INSTANCE_ID, ex=NOTIFY_DEBOUNCE)
+
+async def broadcast_loop():
+    print(f"[broadcast] listening on {CHANGED_CHANNEL}")
+    backoff = 1
+    while True:
+        pubsub = REDIS.pubsub()
+        try:
+            await pubsub.subscribe(CHANGED_CHANNEL)
+            backoff = 1
+            async for event in pubsub.listen():
+                if event["type"] != "message":
+                    continue
+                await announce_change(orjson.loads(event["data"]))
+        except Exception as e:
+            print("[broadcast] error", e)
+            backoff = await backoff_sleep(backoff)
+        finally:
+            await pubsub.aclose()
 
 # ---------- UPDATES LOOP ----------
 OFFSET = None
 
-def process_update(update):
-    if 'message' not in update:
+SUBSCRIBED = {
+    "ar":"تم تفعيل التنبيه.",
+    "fr":"Abonnement activé.",
+    "en":"Subscription activated."
+}
+UNSUBSCRIBED = {
+    "ar":"تم إلغاء الاشتراك.",
+    "fr":"Désabonné.",
+    "en":"Unsubscribed."
+}
+HELP = {
+    "ar":"/minha - تفعيل التنبيه\n/stop - إلغاء الاشتراك\n/help - المساعدة",
+    "fr":"/minha - Activer l'alerte\n/stop - Se désabonner\n/help - Aide",
+    "en":"/minha - Activate alert\n/stop - Unsubscribe\n/help - Help"
+}
+
+# lang is None for commands from clients without a supported language_code;
+# replies then keep the English default
+async def handle_start(chat_id, text, lang):
+    await send_message(chat_id, WELCOME[lang or 'en'])
+
+async def handle_subscribe(chat_id, text, lang):
+    # confirm in the language the alerts will be sent in
+    await send_message(chat_id, SUBSCRIBED[await add_subscriber(chat_id, lang)])
+
+async def handle_unsubscribe(chat_id, text, lang):
+    await remove_subscriber(chat_id)
+    await send_message(chat_id, UNSUBSCRIBED[lang or 'en'])
+
+async def handle_help(chat_id, text, lang):
+    await send_message(chat_id, HELP[lang or 'en'])
+
+async def handle_ai(chat_id, text, lang):
+    await send_message(chat_id, ai_reply(text.lower(), lang or 'en'))
+
+COMMANDS = {
+    '/start': handle_start,
+    '/minha': handle_subscribe,
+    '/stop': handle_unsubscribe,
+    '/unsubscribe': handle_unsubscribe,
+    '/help': handle_help,
+    '/aide': handle_help,
+}
+
+async def process_update(update):
+    # only message updates are requested (ALLOWED_UPDATES); photos, stickers
+    # and other media without text get no reply
+    msg = update.get('message')
+    if not msg:
+        return
+    text = msg.get('text')
+    if not text:
         return
-    msg = update['message']
-    text = msg.get('text','')
     chat_id = msg['chat']['id']
-    lang = detect_language(text)
-
-    if text.startswith('/'):
-        cmd = text.split()[0].lower()
-        if cmd == '/start':
-            send_message(chat_id, WELCOME.get(lang, WELCOME['en']))
-        elif cmd == '/minha':
-            SUBSCRIBERS.add(chat_id)
-            save_subscribers()
-            send_message(chat_id,{
-                "ar":"تم تفعيل التنبيه.",
-                "fr":"Abonnement activé.",
-                "en":"Subscription activated."
-            }[lang])
-        elif cmd in ('/stop','/unsubscribe'):
-            SUBSCRIBERS.discard(chat_id)
-            save_subscribers()
-            send_message(chat_id,"تم إلغاء الاشتراك." if lang=="ar" else ("Unsubscribed." if lang=="en" else "Désabonné."))
-        elif cmd in ('/help','/aide'):
-            send_message(chat_id,{
-                "ar":"/minha - تفعيل التنبيه\n/stop - إلغاء الاشتراك\n/help - المساعدة",
-                "fr":"/minha - Activer l'alerte\n/stop - Se désabonner\n/help - Aide",
-                "en":"/minha - Activate alert\n/stop - Unsubscribe\n/help - Help"
-            }[lang])
+
+    cmd = text.partition(' ')[0].lower() if text.startswith('/') else None
+    if cmd is None:
+        detected = detect_language(text)
+        lang = detected or command_language(msg)
+        if detected:
+            # don't hold the reply back on the language write
+            await asyncio.gather(remember_language(chat_id, detected), handle_ai(chat_id, text, lang))
         else:
-            send_message(chat_id, ai_reply(text, lang))
+            await handle_ai(chat_id, text, lang)
     else:
-        send_message(chat_id, ai_reply(text, lang))
+        lang = command_language(msg)
+        await COMMANDS.get(cmd, handle_ai)(chat_id, text, lang)
 
-def updates_loop():
+async def setup_call(session, method, payload=None):
+    # one-off startup calls: network errors, 5xx and flood control are retried
+    # instead of taking the whole bot down; any other 4xx is a configuration
+    # problem (bad token, bad PUBLIC_URL) and stops the bot
+    backoff = 1
+    while True:
+        try:
+            async with session.post(f"{API_URL}/{method}", json=payload or {}) as r:
+                data = orjson.loads(await r.read())
+        except Exception as e:
+            print(f"[setup] {method} failed:", e)
+            backoff = await backoff_sleep(backoff)
+            continue
+        if data.get('ok'):
+            print(f"[setup] {method}:", data.get('description', 'ok'))
+            return
+        description = data.get('description', f"HTTP {r.status}")
+        if 400 <= r.status < 500 and r.status != 429:
+            raise RuntimeError(f"{method} failed: {description}")
+        print(f"[setup] {method} failed:", description)
+        retry_after = data.get('parameters', {}).get('retry_after')
+        if retry_after:
+            await asyncio.sleep(retry_after)
+        else:
+            backoff = await backoff_sleep(backoff)
+
+async def updates_loop(session):
     global OFFSET
     print("[updates] starting long-polling")
+    # getUpdates is refused while a webhook is registered
+    await setup_call(session, "deleteWebhook")
+    backoff = 1
     while True:
         try:
-            params = {'timeout':30}
+            params = {'timeout':30, 'allowed_updates':orjson.dumps(ALLOWED_UPDATES).decode()}
             if OFFSET:
                 params['offset'] = OFFSET
-            r = requests.get(f"{API_URL}/getUpdates", params=params, timeout=35)
-            data = r.json()
+            async with session.get(f"{API_URL}/getUpdates", params=params,
+                                   timeout=aiohttp.ClientTimeout(total=35)) as r:
+                data = orjson.loads(await r.read())
+            if not data.get('ok'):
+                # 401 bad token, 409 another poller or webhook, 429 flood control:
+                # back off instead of polling again straight away
+                retry_after = data.get('parameters', {}).get('retry_after')
+                if retry_after:
+                    print(f"[updates] rate limited, retrying in {retry_after}s")
+                    await asyncio.sleep(retry_after)
+                    continue
+                raise RuntimeError(data.get('description', f"HTTP {r.status}"))
             for upd in data.get('result',[]):
                 OFFSET = upd['update_id'] + 1
-                process_update(upd)
+                await process_update(upd)
+            backoff = 1
         except Exception as e:
             print("[updates] error", e)
-            time.sleep(2)
+            backoff = await backoff_sleep(backoff)
 
 # ---------- HEALTH SERVER ----------
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type','text/plain')
-        self.end_headers()
-        self.wfile.write(b'AlgeriaMinha bot running')
-
-def run_web_server():
+HEALTH_BODY = b'AlgeriaMinha bot running'
+
+async def health(request):
+    return web.Response(body=HEALTH_BODY, content_type='text/plain')
+
+WEBHOOK_TASKS = set()
+
+async def handle_webhook_update(update):
+    try:
+        await process_update(update)
+    except Exception as e:
+        print("[webhook] error", e)
+
+async def telegram_webhook(request):
+    # answer 200 right away and handle the update in the background: a slow
+    # reply must not make Telegram time out and redeliver the update
+    try:
+        update = orjson.loads(await request.read())
+    except Exception as e:
+        print("[webhook] bad update", e)
+        return web.Response()
+    task = asyncio.create_task(handle_webhook_update(update))
+    WEBHOOK_TASKS.add(task)
+    task.add_done_callback(WEBHOOK_TASKS.discard)
+    return web.Response()
+
+async def set_webhook(session):
+    payload = {"url": f"{PUBLIC_URL}{WEBHOOK_PATH}", "allowed_updates": ALLOWED_UPDATES}
+    await setup_call(session, "setWebhook", payload)
+
+async def run_web_server(session):
     port = int(os.getenv('PORT', '8000'))
-    server = HTTPServer(('0.0.0.0', port), HealthHandler)
+    app = web.Application()
+    if PUBLIC_URL:
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    app.router.add_get('/{tail:.*}', health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
     print(f"[web] running on port {port}")
-    server.serve_forever()
+    try:
+        if PUBLIC_URL:
+            await set_webhook(session)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 # ---------- MAIN ----------
+async def main():
+    # one pooled keep-alive connector for Telegram and ANEM: TLS handshakes are
+    # paid once per connection, not once per request
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300, keepalive_timeout=30)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        try:
+            services = [run_web_server(session), monitor_loop(session), broadcast_loop()]
+            services += [sender(session) for _ in range(SEND_CONCURRENCY)]
+            if not PUBLIC_URL:
+                services.append(updates_loop(session))
+            await asyncio.gather(*services)
+        finally:
+            await REDIS.aclose()
+
 if __name__ == "__main__":
-    threading.Thread(target=run_web_server, daemon=True).start()
-    threading.Thread(target=monitor_loop, daemon=True).start()
-    updates_loop()
+    asyncio.run(main())